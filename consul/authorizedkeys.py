@@ -1,33 +1,120 @@
 #!/usr/bin/env python3
+"""AuthorizedKeysCommand of sshd::
 
+    AuthorizedKeysCommand /sbin/authorizedkeys.py %f %k
+
+The public keys of the apps are indexed by fingerprint in INDEX, so a login
+attempt only reads one small file. The index is regenerated by a consul
+watch on the app/ prefix::
+
+    authorizedkeys.py --update
+
+Without the index, or without arguments, the keys are read from consul.
+"""
 import json
+import os
 import socket
-from subprocess import run, PIPE
-from urllib.parse import urlparse
+import sys
+from base64 import b64decode, b64encode
+from consulclient import Consul
+from hashlib import sha256
+from os.path import exists, join
+INDEX = os.environ.get('AUTHORIZED_KEYS_INDEX', '/deploy/authorized_keys')
+READY = '.ready'
+TIMEOUT = 3  # don't keep sshd waiting if consul is slow
+
+
+def apps(timeout=30):
+    return Consul().kv_items('app/', timeout=timeout).values()
+
+
+def fingerprint(blob):
+    """SHA256 fingerprint of a base64 key, as given by sshd with %f"""
+    digest = sha256(b64decode(blob)).digest()
+    return 'SHA256:' + b64encode(digest).decode('utf-8').rstrip('=')
 
 
-def apps():
-    cmd = "consul kv get --recurse app/"
-    res = run(cmd, shell=True, check=True, stdout=PIPE, stderr=PIPE)
-    return res.stdout.decode('utf-8').strip().splitlines()
+def filename(fprint):
+    return fprint.replace('/', '_')
 
 
-for app in apps():
-    data = json.loads(app.split(':', 1)[1])
-    pubkeys = data.get('pubkey')
-    cts = data.get('ct')
-    domain = data.get('domain')
-    ip = data.get('ip')
-    target = data.get('master')
+def authorized_keys(apps):
+    """return the authorized_keys lines of the apps and their fingerprints
+    """
     myself = socket.gethostname()
-    if not pubkeys:
-        continue
-
-    for s, ct in cts.items():
-        pubkey = pubkeys[s]
-        if pubkey.strip() and '\n' not in pubkey:
-            if myself == target:
-                print('command="docker exec -it {ct} bash" {pubkey}'
-                      .format(**locals()))
-            else:
-                print('command="ssh -At gw@{ip}" {pubkey}'.format(**locals()))
+    for app in apps:
+        data = json.loads(app)
+        pubkeys = data.get('pubkey')
+        cts = data.get('ct')
+        ip = data.get('ip')
+        target = data.get('master')
+        if not pubkeys:
+            continue
+
+        for s, ct in cts.items():
+            pubkey = pubkeys[s]
+            if pubkey.strip() and '\n' not in pubkey:
+                try:
+                    fprint = fingerprint(pubkey.split()[1])
+                except Exception:
+                    fprint = None  # still usable without the index
+                if myself == target:
+                    yield fprint, ('command="docker exec -it {ct} bash" '
+                                   '{pubkey}'.format(**locals()))
+                else:
+                    yield fprint, ('command="ssh -At gw@{ip}" {pubkey}'
+                                   .format(**locals()))
+
+
+def update(apps, index=INDEX):
+    """regenerate the index: one file per fingerprint"""
+    keys = {}
+    for fprint, line in authorized_keys(apps):
+        if fprint is not None:
+            keys.setdefault(filename(fprint), []).append(line)
+    os.makedirs(index, mode=0o755, exist_ok=True)
+    for name, lines in keys.items():
+        path = join(index, name)
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(path + '.tmp', 0o644)
+        os.rename(path + '.tmp', path)
+    for name in os.listdir(index):
+        if name not in keys and name != READY:
+            os.remove(join(index, name))
+    open(join(index, READY), 'w').close()
+    os.chmod(join(index, READY), 0o644)
+
+
+def lookup(fprint, blob=None, index=INDEX):
+    """authorized_keys lines for a key.
+    The fingerprint is computed from the key if available
+    """
+    if blob:
+        fprint = fingerprint(blob)
+    if exists(join(index, READY)):
+        try:
+            with open(join(index, filename(fprint))) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+    # no index yet
+    try:
+        return [line for f, line in authorized_keys(apps(timeout=TIMEOUT))
+                if f == fprint]
+    except Exception:
+        return []
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--update']:
+        # consul watch handler, the keys are given on stdin
+        entries = json.loads(sys.stdin.read() or 'null') or []
+        update(b64decode(e['Value']).decode('utf-8')
+               for e in entries if e.get('Value'))
+    elif len(sys.argv) >= 2:
+        for line in lookup(*sys.argv[1:3]):
+            print(line)
+    else:
+        for fprint, line in authorized_keys(apps()):
+            print(line)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Benchmarks of the hot paths of the handler.
+They run offline, against the in-memory consul of the tests and synthetic
+data. Run them in the consul directory::
+
+    $ ./benchmark.py            # tables
+    $ ./benchmark.py --json     # one json object per measure
+    $ ./benchmark.py check      # only some of the benchmarks
+
+The time per item should stay constant while the inputs grow, except for
+the lookups (check, authorized keys), which should not depend on the number
+of apps at all.
+"""
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from os.path import join
+from shutil import copy, rmtree
+
+import authorizedkeys
+import handler
+from handler import Application, Caddyfile, TestDockerSession, TestSession
+
+SIZES = (10, 100, 1000)
+REPO = 'https://gitlab.example.com/hosting/FooBar'
+
+
+def caddyfile(hosts):
+    """a synthetic caddyfile with many hosts"""
+    return '\n'.join(
+        'http://host{0}.example.com, https://host{0}.example.com {{\n'
+        '    proxy / http://ct{0}:80 {{\n'
+        '        websocket\n'
+        '        header_upstream Host {{host}}\n'
+        '    }}\n'
+        '    log / stdout "{{hostonly}} \\"{{method}} {{uri}}\\" {{status}}"\n'
+        '    gzip\n'
+        '}}'.format(i) for i in range(hosts))
+
+
+def compose(services):
+    """a synthetic compose whose services share a haproxy frontend"""
+    return json.dumps({'version': '3', 'services': {
+        'ssh{}'.format(i): {'image': 'sshd', 'environment': {
+            'HAPROXY': json.dumps({'ssh': {
+                'frontend': {'mode': 'tcp', 'bind': ['*:{}'.format(2000 + i)],
+                             'options': ['option tcplog']},
+                'backends': [{'name': 'ssh{}'.format(i), 'port': '22',
+                              'peer_port': str(2000 + i)}]}})}}
+        for i in range(services)}})
+
+
+def record(i, pubkey=''):
+    """a synthetic app record"""
+    return json.dumps({
+        'master': 'node{}'.format(i % 3 + 1), 'slave': None,
+        'ip': '10.10.10.1{}'.format(i % 3 + 1),
+        'urls': 'http://app{0}.example.com, https://app{0}.example.com'
+                .format(i),
+        'domains': ['app{}.example.com'.format(i)],
+        'ct': {'web': 'app{}_web_1'.format(i)},
+        'pubkey': {'web': pubkey}})
+
+
+def pubkey(rand):
+    return 'ssh-ed25519 ' + b64encode(
+        bytes(rand.getrandbits(8) for i in range(51))).decode()
+
+
+def timeit(func, *args, repeat=3, setup=None):
+    """best time of several runs. setup() is called before each run"""
+    best = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func(*args)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def result(bench, n, seconds):
+    return {'bench': bench, 'n': n, 'seconds': round(seconds, 6),
+            'us_per_item': round(seconds / n * 1e6, 2)}
+
+
+def checkout(app, text):
+    """a checkout of the app, without git"""
+    app._deploy_date = 'benchmark'
+    os.makedirs(app.path, exist_ok=True)
+    with open(join(app.path, 'docker-compose.yml'), 'w') as f:
+        f.write(text)
+
+
+def parse(text):
+    """parse without the memo"""
+    Caddyfile._memo.clear()
+    return Caddyfile.loads(text)
+
+
+def bench_loads(sizes=SIZES + (10000,)):
+    for hosts in sizes:
+        yield result('Caddyfile.loads', hosts, timeit(parse, caddyfile(hosts)))
+
+
+def bench_dumps(sizes=SIZES + (10000,)):
+    for hosts in sizes:
+        parsed = Caddyfile.loads(caddyfile(hosts))
+        yield result('Caddyfile.dumps', hosts, timeit(Caddyfile.dumps, parsed))
+
+
+def bench_check(sizes=SIZES):
+    """check of a new app against n registered apps"""
+    for apps in sizes:
+        handler.CONSUL.session = TestSession()
+        for i in range(apps):
+            handler.CONSUL.kv_put('app/app{}'.format(i), record(i))
+        app = Application(REPO, 'master')
+        with open(join(handler.HERE, '..', 'testapp', 'FooBar.yml')) as f:
+            checkout(app, f.read())
+        yield result('Routes.build', apps, timeit(handler.Routes.build,
+                                                  repeat=1))
+        yield result('Application.check', apps, timeit(app.check, 'node1'))
+
+
+def bench_haproxy(sizes=SIZES):
+    """merge of the haproxy confs of n services"""
+    for services in sizes:
+        app = Application(REPO, 'master')
+        checkout(app, compose(services))
+        app.spec  # the compose is parsed once, then cached
+        yield result('Application.haproxy', services,
+                     timeit(app.haproxy, app.services))
+
+
+def bench_eventlog(sizes=(1000, 10000, 100000)):
+    """handle() of a batch of already handled events, with a long log"""
+    path = join(handler.DEPLOY, 'events.log')
+    for lines in sizes:
+        with open(path + '.orig', 'w') as f:
+            f.writelines('{} {}\n'.format(i, i) for i in range(lines))
+        events = json.dumps([{'ID': str(i), 'LTime': i, 'Name': 'deploy'}
+                             for i in range(lines - 256, lines)])
+        yield result('handle (dedup)', lines,
+                     timeit(handler.handle, events, 'node1',
+                            setup=lambda: copy(path + '.orig', path)))
+        # the next ones read the compacted log
+        yield result('handle (compacted)', lines,
+                     timeit(handler.handle, events, 'node1'))
+
+
+def bench_authorizedkeys(sizes=SIZES):
+    rand = random.Random(0)
+    index = join(handler.DEPLOY, 'authorized_keys')
+    for apps in sizes:
+        keys = [pubkey(rand) for i in range(apps)]
+        records = [record(i, keys[i]) for i in range(apps)]
+        yield result('authorizedkeys (all keys)', apps, timeit(
+            lambda: list(authorizedkeys.authorized_keys(records))))
+        yield result('authorizedkeys.update', apps,
+                     timeit(authorizedkeys.update, records, index))
+        yield result('authorizedkeys.lookup', apps,
+                     timeit(authorizedkeys.lookup, None, keys[-1].split()[1],
+                            index))
+
+
+BENCHMARKS = (
+    ('loads', bench_loads),
+    ('dumps', bench_dumps),
+    ('check', bench_check),
+    ('haproxy', bench_haproxy),
+    ('eventlog', bench_eventlog),
+    ('authorizedkeys', bench_authorizedkeys),
+)
+
+
+def run(names, out):
+    """run the benchmarks in a temporary DEPLOY, with the in-memory consul
+    and docker
+    """
+    deploy, session = handler.DEPLOY, handler.CONSUL.session
+    docker = handler.DOCKER.session
+    handler.DEPLOY = tempfile.mkdtemp()
+    handler.CONSUL.session = TestSession()
+    handler.DOCKER.session = TestDockerSession()
+    try:
+        for name, bench in BENCHMARKS:
+            if name in names:
+                for res in bench():
+                    out(res)
+    finally:
+        rmtree(handler.DEPLOY)
+        handler.DEPLOY, handler.CONSUL.session = deploy, session
+        handler.DOCKER.session = docker
+
+
+def tables(results):
+    """print the results as one table per benchmark"""
+    benches = []
+    for res in results:
+        if res['bench'] not in benches:
+            benches.append(res['bench'])
+    for bench in benches:
+        print('\n' + bench)
+        print('{:>8} {:>12} {:>14}'.format('n', 'seconds', 'us per item'))
+        for res in results:
+            if res['bench'] == bench:
+                print('{:>8} {:>12.4f} {:>14.1f}'.format(
+                    res['n'], res['seconds'], res['us_per_item']))
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.ERROR)
+    args = sys.argv[1:]
+    names = [a for a in args if a != '--json'] or [n for n, b in BENCHMARKS]
+    if '--json' in args:
+        run(names, lambda res: print(json.dumps(res), flush=True))
+    else:
+        results = []
+        run(names, results.append)
+        tables(results)
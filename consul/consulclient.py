@@ -0,0 +1,224 @@
+# coding: utf-8
+import json
+import logging
+import os
+import requests
+from base64 import b64decode, b64encode
+log = logging.getLogger()
+CONSUL_URL = os.environ.get('CONSUL_URL', 'http://localhost:8500')
+TIMEOUT = 30
+TXN_SIZE = 64  # maximum number of operations in a transaction
+STATUSES = {0: 'none', 1: 'alive', 2: 'leaving', 3: 'left', 4: 'failed'}
+
+
+class Consul(object):
+    """ client for the HTTP API of the local consul agent.
+    All the requests go through the same keep-alive session
+    """
+    def __init__(self, url=CONSUL_URL, session=None):
+        self.url = url.rstrip('/')
+        self.session = session or requests.Session()
+
+    def request(self, method, path, params=None, data=None,
+                timeout=TIMEOUT, notfound=False, conflict=False):
+        """send a request to the agent and return the response.
+        A 404 is only accepted if notfound is True (missing keys),
+        a 409 if conflict is True (rolled back transactions)
+        """
+        res = self.session.request(
+            method, self.url + path,
+            params=params, data=data, timeout=timeout)
+        if res.status_code == 404 and notfound:
+            return res
+        if res.status_code == 409 and conflict:
+            return res
+        if res.status_code != 200:
+            msg = 'Consul request {} {} failed: {} {}'.format(
+                method, path, res.status_code, res.text)
+            log.error(msg)
+            raise RuntimeError(msg)
+        return res
+
+    # key/value store
+
+    def kv_get(self, key):
+        """return the value of the key, or None if it does not exist"""
+        res = self.request('GET', '/v1/kv/' + key, notfound=True)
+        if res.status_code == 404:
+            return None
+        value = res.json()[0]['Value']
+        return b64decode(value).decode('utf-8') if value else ''
+
+    def kv_entry(self, key):
+        """return the value of the key and its ModifyIndex,
+        to be used for a check-and-set. (None, 0) if it does not exist
+        """
+        res = self.request('GET', '/v1/kv/' + key, notfound=True)
+        if res.status_code == 404:
+            return None, 0
+        entry = res.json()[0]
+        value = entry['Value']
+        return (b64decode(value).decode('utf-8') if value else '',
+                entry['ModifyIndex'])
+
+    def kv_items(self, prefix, timeout=TIMEOUT):
+        """return a dict of all the keys and values under the prefix"""
+        res = self.request('GET', '/v1/kv/' + prefix, params={'recurse': ''},
+                           timeout=timeout, notfound=True)
+        if res.status_code == 404:
+            return {}
+        return {i['Key']: b64decode(i['Value']).decode('utf-8')
+                if i['Value'] else '' for i in res.json()}
+
+    def kv_keys(self, prefix):
+        """return the list of the keys under the prefix"""
+        res = self.request('GET', '/v1/kv/' + prefix,
+                           params={'keys': ''}, notfound=True)
+        if res.status_code == 404:
+            return []
+        return res.json()
+
+    def kv_watch(self, prefix, index=0, wait=60):
+        """blocking query on the keys under the prefix.
+        Return as soon as the prefix changes after the given index, or after
+        `wait` seconds. Return the new index and the list of keys.
+        """
+        wait = max(1, wait)  # consul would wait 5 minutes for 0ms
+        res = self.request('GET', '/v1/kv/' + prefix,
+                           params={'keys': '', 'index': index,
+                                   'wait': '{}ms'.format(int(wait * 1000))},
+                           timeout=wait + TIMEOUT, notfound=True)
+        newindex = int(res.headers.get('X-Consul-Index', 0))
+        if newindex < index:  # the index went backwards, restart from 0
+            newindex = 0
+        return max(newindex, 1), [] if res.status_code == 404 else res.json()
+
+    def kv_put(self, key, value='', cas=None):
+        """write the key. With a cas index, only write if the key has not
+        changed since (0 means it must not exist). Return whether it was set
+        """
+        params = {'cas': cas} if cas is not None else None
+        return self.request('PUT', '/v1/kv/' + key, params=params,
+                            data=value.encode('utf-8')).json()
+
+    def kv_delete(self, key, recurse=False, cas=None):
+        params = {}
+        if recurse:
+            params['recurse'] = ''
+        if cas is not None:
+            params['cas'] = cas
+        return self.request('DELETE', '/v1/kv/' + key,
+                            params=params or None).json()
+
+    # transactions
+
+    @staticmethod
+    def op_set(key, value='', cas=None):
+        """transaction operation writing the key, like kv_put"""
+        op = {'Verb': 'set' if cas is None else 'cas', 'Key': key,
+              'Value': b64encode(value.encode('utf-8')).decode('utf-8')}
+        if cas is not None:
+            op['Index'] = cas
+        return op
+
+    @staticmethod
+    def op_delete(key, recurse=False, cas=None):
+        """transaction operation deleting the key, like kv_delete"""
+        if recurse:
+            return {'Verb': 'delete-tree', 'Key': key}
+        if cas is not None:
+            return {'Verb': 'delete-cas', 'Key': key, 'Index': cas}
+        return {'Verb': 'delete', 'Key': key}
+
+    def txn(self, operations):
+        """apply the operations atomically: all of them or none if a
+        check-and-set fails. Return whether they were applied
+        """
+        if not operations:
+            return True
+        if len(operations) > TXN_SIZE:
+            raise ValueError('Too many operations in a transaction: {}'
+                             .format(len(operations)))
+        res = self.request('PUT', '/v1/txn', data=json.dumps(
+            [{'KV': op} for op in operations]), conflict=True)
+        if res.status_code == 409:
+            log.info('Transaction rolled back: %s', res.text)
+            return False
+        return True
+
+    # sessions and locks
+
+    def session_create(self, name, ttl=60):
+        """create a session. Its locks are released when it is destroyed or
+        when it expires
+        """
+        data = json.dumps({'Name': name, 'TTL': '{}s'.format(ttl),
+                           'Behavior': 'release', 'LockDelay': '0s'})
+        return self.request('PUT', '/v1/session/create',
+                            data=data).json()['ID']
+
+    def session_renew(self, session):
+        """reset the TTL of the session"""
+        self.request('PUT', '/v1/session/renew/' + session)
+
+    def session_destroy(self, session):
+        self.request('PUT', '/v1/session/destroy/' + session)
+
+    def kv_acquire(self, key, session, value=''):
+        """lock the key with the session. Return whether it was acquired"""
+        return self.request('PUT', '/v1/kv/' + key,
+                            params={'acquire': session},
+                            data=value.encode('utf-8')).json()
+
+    def kv_release(self, key, session):
+        return self.request('PUT', '/v1/kv/' + key,
+                            params={'release': session}).json()
+
+    # agent
+
+    def members(self):
+        """return the members of the cluster, indexed by node name"""
+        return {m['Name']: {'ip': m['Addr'],
+                            'status': STATUSES.get(m['Status'], 'unknown')}
+                for m in self.request('GET', '/v1/agent/members').json()}
+
+    def service_register(self, svc):
+        """register a service, given as a json string"""
+        self.request('PUT', '/v1/agent/service/register', data=svc)
+
+    def service_deregister(self, name):
+        self.request('PUT', '/v1/agent/service/deregister/' + name)
+
+    # catalog
+
+    def nodes(self):
+        return self.request('GET', '/v1/catalog/nodes').json()
+
+    def service(self, name):
+        return self.request('GET', '/v1/catalog/service/' + name).json()
+
+    # events
+
+    def fire(self, name, payload):
+        """fire a custom user event and return its ID"""
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        res = self.request('PUT', '/v1/event/fire/' + name,
+                           data=payload.encode('utf-8'))
+        return res.json()['ID']
+
+    def events(self, name=None):
+        """return the most recent events known by the agent"""
+        params = {'name': name} if name else None
+        return self.request('GET', '/v1/event/list', params=params).json()
+
+    def event_watch(self, index=0, wait=60):
+        """blocking query on the events known by the agent.
+        Return the new index and the events, oldest first
+        """
+        wait = max(1, wait)  # consul would wait 5 minutes for 0ms
+        res = self.request('GET', '/v1/event/list',
+                           params={'index': index,
+                                   'wait': '{}ms'.format(int(wait * 1000))},
+                           timeout=wait + TIMEOUT)
+        return int(res.headers.get('X-Consul-Index', 0)), res.json()
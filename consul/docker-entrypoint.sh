@@ -6,8 +6,14 @@ chown -R consul: /deploy
 caddytemplate="/consul/template/caddy/Caddyfile.ctmpl:/consul/template/caddy/Caddyfile:/reload_caddy.sh"
 haproxytemplate="/consul/template/haproxy/haproxy.cfg.ctmpl:/consul/template/haproxy/haproxy.cfg:/reload_haproxy.sh"
 
-/bin/consul-template -once -template=$caddytemplate -template=$haproxytemplate &
-/bin/consul-template       -template=$caddytemplate -template=$haproxytemplate &
+if [ -n "$HANDLER_RENDER" ]; then
+    # the handler renders the configurations and reloads the proxies
+    chown consul: /consul/template/caddy /consul/template/haproxy
+    su-exec consul:docker /handler.py render &
+else
+    /bin/consul-template -once -template=$caddytemplate -template=$haproxytemplate &
+    /bin/consul-template       -template=$caddytemplate -template=$haproxytemplate &
+fi
 
 # adapt the docker group of the container to the outside
 DOCKER_GID=$(stat -c %g /run/docker.sock)
@@ -23,4 +29,9 @@ if [ -e $PLUGINS ]; then
     chgrp -R docker $PLUGINS
 fi
 
+# long running event handler, the event watch then does nothing
+if [ -n "$HANDLER_DAEMON" ]; then
+    su-exec consul:docker /handler.py daemon &
+fi
+
 exec /usr/local/bin/docker-entrypoint.sh "$@"
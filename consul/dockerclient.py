@@ -0,0 +1,128 @@
+# coding: utf-8
+import http.client
+import json
+import logging
+import os
+import socket
+import threading
+from urllib.parse import quote, urlencode
+log = logging.getLogger()
+DOCKER_SOCKET = os.environ.get('DOCKER_SOCKET', '/run/docker.sock')
+TIMEOUT = 30
+PROJECT = 'com.docker.compose.project'
+SERVICE = 'com.docker.compose.service'
+NUMBER = 'com.docker.compose.container-number'
+
+
+class UnixConnection(http.client.HTTPConnection):
+    """ HTTP connection over a unix socket"""
+    def __init__(self, path, timeout=TIMEOUT):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class Session(threading.local):
+    """ keep-alive connection to the docker socket, one per thread"""
+    def __init__(self, path=DOCKER_SOCKET):
+        self.path = path
+        self.connection = None
+
+    def request(self, method, path):
+        """send a request and return the status and the decoded body.
+        A kept connection closed by the daemon is reopened once
+        """
+        while True:
+            reused = self.connection is not None
+            if not reused:
+                self.connection = UnixConnection(self.path)
+            try:
+                self.connection.request(method, path)
+                res = self.connection.getresponse()
+                body = res.read()
+                break
+            except (http.client.HTTPException, OSError):
+                self.connection.close()
+                self.connection = None
+                if not reused:
+                    raise
+        return res.status, json.loads(body.decode('utf-8')) if body else None
+
+
+class Docker(object):
+    """ client for the Docker Engine API on the local socket.
+    The volumes and the containers are listed once, then kept until
+    forget() is called: at each event, and after each change
+    """
+    def __init__(self, session=None):
+        self.session = session or Session()
+        self.cache = threading.local()
+
+    def request(self, method, path, params=None):
+        if params:
+            path += '?' + urlencode(params)
+        status, content = self.session.request(method, path)
+        if status >= 400:
+            msg = 'Docker request {} {} failed: {} {}'.format(
+                method, path, status, content)
+            log.error(msg)
+            raise RuntimeError(msg)
+        return content
+
+    def listing(self, name, path, params=None):
+        if name not in vars(self.cache):
+            setattr(self.cache, name, self.request('GET', path, params))
+        return getattr(self.cache, name)
+
+    def forget(self):
+        """ drop the listings"""
+        vars(self.cache).clear()
+
+    def volumes(self, driver=None):
+        """names of the volumes, only those of a driver if given"""
+        volumes = self.listing('volumes', '/volumes').get('Volumes') or []
+        return [v['Name'] for v in volumes
+                if driver is None or v['Driver'] == driver]
+
+    def remove_volume(self, name):
+        log.info('Removing the volume %s', name)
+        self.request('DELETE', '/volumes/' + quote(name, safe=''))
+        self.forget()
+
+    def containers(self, project):
+        """names of the containers of a compose project, by service.
+        The first container is used if a service is scaled
+        """
+        containers = {}
+        listing = self.listing('containers', '/containers/json', {'all': 1})
+        for ct in sorted(listing, reverse=True, key=lambda c: int(
+                (c.get('Labels') or {}).get(NUMBER, 0))):
+            labels = ct.get('Labels') or {}
+            if labels.get(PROJECT) == project and SERVICE in labels:
+                containers[labels[SERVICE]] = ct['Names'][0].lstrip('/')
+        return containers
+
+    def kill(self, container, signal='KILL'):
+        """send a signal to a container"""
+        self.request('POST', '/containers/{}/kill'.format(
+            quote(container, safe='')), {'signal': signal})
+
+    def restart(self, container):
+        self.request('POST', '/containers/{}/restart'.format(
+            quote(container, safe='')))
+        self.forget()
+
+    def status(self, container):
+        """status of a running container, as given by docker ps.
+        The listing also has the stopped containers, which are ignored
+        """
+        listing = self.listing('containers', '/containers/json', {'all': 1})
+        for ct in listing:
+            if '/' + container in ct['Names'] and ct['State'] == 'running':
+                return ct['Status']
+        return ''
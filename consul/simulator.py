@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Simulation of deployments on a cluster of three nodes, in one process.
+Each node handles the events in its own thread, like the real handlers, and
+they coordinate through the in-memory consul of the tests. The commands
+(git, docker, docker-compose, buttervolume) are not run: the backends only
+sleep for a configurable latency. Run it in the consul directory::
+
+    $ ./simulator.py
+    $ ./simulator.py --latency "buttervolume send=60" --latency consul=0.05
+    $ ./simulator.py --json
+
+The latencies are given in simulated seconds, and `--scale` is the real
+time of a simulated second (0.01s by default, so 100 times faster than the
+real time). Each node has its own DEPLOY folder. The report gives the
+timeline of the phases of each node for each event, and the downtime of
+each app: the time it was in maintenance on any node.
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from base64 import b64encode
+from collections import OrderedDict
+from datetime import datetime
+from os.path import basename, join
+from shutil import rmtree
+from uuid import uuid1
+
+import handler
+from handler import AppSpec, TestSession, concat
+
+NODES = ('node1', 'node2', 'node3')
+
+# latency of each command, in simulated seconds
+LATENCIES = OrderedDict([
+    ('consul', 0.005),  # any request to the consul agent
+    ('git clone', 3),
+    ('git remote', 1),
+    ('docker-compose pull', 20),
+    ('docker-compose build', 60),
+    ('docker-compose up', 10),
+    ('docker-compose down', 5),
+    ('docker', 0.005),  # any request to the docker socket
+    ('buttervolume snapshot', 2),
+    ('buttervolume send', 30),
+    ('buttervolume restore', 3),
+    ('buttervolume schedule', 0.2),
+])
+
+STATELESS = ('site',)  # repos without volumes
+
+SCENARIO = [
+    ('deploy', {'repo': 'shop', 'branch': 'master',
+                'master': 'node1', 'slave': 'node2'}),
+    ('deploy', {'repo': 'shop', 'branch': 'master',
+                'master': 'node1', 'slave': 'node2'}),
+    ('deploy', {'repo': 'shop', 'branch': 'master',
+                'master': 'node2', 'slave': 'node1'}),
+    ('deploy', {'repo': 'shop', 'branch': 'master', 'master': 'node3'}),
+    ('deploy', {'repo': 'shop', 'branch': 'preprod', 'master': 'node1'}),
+    ('migrate', {'repo': 'shop', 'branch': 'master',
+                 'target': {'branch': 'preprod'}}),
+    ('destroy', {'repo': 'shop', 'branch': 'preprod'}),
+    ('deploy', {'repo': 'site', 'branch': 'master', 'master': 'node1'}),
+    ('deploy', {'repo': 'site', 'branch': 'master', 'master': 'node1',
+                'bluegreen': True}),
+    ('deploy', {'repo': 'blog', 'branch': 'master',
+                'master': 'node1', 'slave': 'node2'}),
+    ('deploy', {'repo': 'wiki', 'branch': 'master',
+                'master': 'node1', 'slave': 'node3'}),
+    ('evacuate', {'node': 'node1'}),
+]
+
+
+def compose(repo, branch):
+    """a synthetic compose file"""
+    host = '{}.{}.test.example.com'.format(branch, repo)
+    stateless = repo in STATELESS
+    services = {'web': {
+        'image': 'nginx',
+        'environment': {
+            'CADDYFILE': 'http://%s {\n    proxy / http://$CONTAINER:80\n}'
+                         % host}}}
+    if stateless:
+        return json.dumps({'version': '2', 'services': services})
+    services['web']['volumes'] = ['data:/data']
+    services['db'] = {'image': 'postgres', 'volumes': ['db:/var/lib/pgsql']}
+    return json.dumps({'version': '2', 'services': services, 'volumes': {
+        'data': {'driver': handler.BTRFSDRIVER},
+        'db': {'driver': handler.BTRFSDRIVER}}})
+
+
+def union(intervals):
+    """total length of the union of the (start, end) intervals"""
+    total, end = 0, None
+    for begin, finish in sorted(intervals):
+        if end is None or begin > end:
+            total += finish - begin
+            end = finish
+        elif finish > end:
+            total += finish - end
+            end = finish
+    return total
+
+
+class Deploy(threading.local):
+    """DEPLOY folder of the node handling the event in the current thread"""
+    def __init__(self, root):
+        self.root = root
+        self.node = None
+
+    def __fspath__(self):
+        return join(self.root, self.node) if self.node else self.root
+
+
+class Simulator(object):
+    """run events on all the nodes with fake commands and consul"""
+    def __init__(self, latencies=LATENCIES, scale=0.01):
+        self.latencies = latencies
+        self.scale = scale
+        self.volumes = set()  # btrfs volumes of the cluster
+        self.lock = threading.Lock()
+        self.spans = []  # (node, transition, spans) of the handled events
+
+    def sleep(self, name):
+        time.sleep(self.latencies.get(name, 0) * self.scale)
+
+    def run(self, cmd, cwd=None):
+        """fake runner of the backends"""
+        args = list(cmd)
+        if args[0] == 'docker-compose' and args[1] == '-p':
+            args = args[:1] + args[3:] + args[1:3]  # project at the end
+        name = ' '.join(args[:2])
+        self.sleep(name)
+        if name == 'git clone' and args[2] == '--mirror':
+            os.makedirs(args[4], exist_ok=True)
+            with open(join(args[4], 'url'), 'w') as f:
+                f.write(args[3])
+        elif name == 'git clone':
+            branch, source, path = args[-3:]
+            if source.startswith('file://'):
+                with open(join(source[len('file://'):], 'url')) as f:
+                    source = f.read()
+            os.makedirs(path, exist_ok=True)
+            with open(join(path, 'docker-compose.yml'), 'w') as f:
+                f.write(compose(basename(source), branch))
+        elif name == 'docker-compose up':
+            project = args[-1]
+            with self.lock:
+                self.volumes.update(project + '_' + v for v in
+                                    AppSpec.load(cwd, project).volumes)
+        elif name == 'buttervolume snapshot':
+            return '{}@{}'.format(args[2],
+                                  datetime.now().strftime(handler.DTFORMAT))
+        elif name == 'buttervolume restore':
+            with self.lock:
+                self.volumes.add(args[3] if len(args) > 3
+                                 else args[2].split('@')[0])
+        return ''
+
+    def event(self, name, payload):
+        if 'repo' in payload:
+            payload = dict(payload, repo='https://git.example.com/' +
+                           payload['repo'])
+        if 'target' in payload:
+            payload['target'] = dict(payload['target'], repo=payload['repo'])
+        return {'ID': str(uuid1()), 'Name': name, 'Version': 1, 'LTime': 0,
+                'Payload': b64encode(json.dumps(payload).encode('utf-8')
+                                     ).decode('utf-8')}
+
+    def save_spans(self, myself):
+        """collect the spans of each event handled by a node"""
+        with self.lock:
+            self.spans.append((myself, handler.SPANS.transition,
+                               list(handler.SPANS.spans)))
+        self.original['save_spans'](myself)
+
+    def handle_event(self, event, myself, *args, **kwargs):
+        """handle an event in the DEPLOY folder of the node"""
+        self.deploy.node = myself
+        return self.original['handle_event'](event, myself, *args, **kwargs)
+
+    def event_context(self):
+        """the workers of an event also work in the DEPLOY of its node"""
+        return self.deploy.node, self.original['event_context']()
+
+    def adopt(self, context):
+        self.deploy.node, context = context
+        self.original['adopt'](context)
+
+    def handle(self, event):
+        """handle the event on all the nodes at the same time, then the
+        events fired meanwhile, like the daemons would. Return the errors of
+        each node
+        """
+        errors = {}
+        threads = []
+        events = handler.CONSUL.session.events
+        fired = len(events)
+
+        def node(myself, event):
+            try:
+                handler.handle_event(event, myself)
+            except Exception as e:
+                errors[myself] = str(e)
+        while True:
+            for thread in [threading.Thread(target=node, args=(n, event))
+                           for n in NODES]:
+                thread.start()
+                threads.append(thread)
+            while fired == len(events) and any(t.is_alive() for t in threads):
+                time.sleep(0.01)
+            if fired == len(events):
+                break
+            event = events[fired]
+            fired += 1
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def step(self, name, payload):
+        """run an event and return its timeline"""
+        event = self.event(name, payload)
+        start = time.time()
+        self.spans = []
+        errors = self.handle(event)
+        nodes = OrderedDict()
+        downtimes = OrderedDict()  # app: intervals in maintenance
+        for myself in NODES:
+            transitions = [t for n, t, e in self.spans if n == myself and t]
+            phases = []
+            for entry in concat(e for n, t, e in self.spans if n == myself):
+                begin = datetime.strptime(
+                    entry['date'], handler.DTFORMAT).timestamp()
+                phases.append(OrderedDict([
+                    ('phase', entry['phase']),
+                    ('start', round((begin - start) / self.scale, 1)),
+                    ('duration', round(entry['duration'] / self.scale, 1)),
+                    ('outcome', entry['outcome'])]))
+                if entry['phase'] == 'downtime':
+                    downtimes.setdefault(entry['app'], []).append(
+                        (begin, begin + entry['duration']))
+            nodes[myself] = OrderedDict([
+                ('transition',
+                 ', '.join(transitions) or 'nothing -> nothing'),
+                ('phases', phases),
+                ('error', errors.get(myself))])
+        return OrderedDict([
+            ('event', name),
+            ('payload', payload),
+            ('duration', round((time.time() - start) / self.scale, 1)),
+            ('downtime', OrderedDict(
+                (app, round(union(intervals) / self.scale, 1))
+                for app, intervals in downtimes.items())),
+            ('nodes', nodes)])
+
+    def simulate(self, scenario=SCENARIO):
+        """run the events of the scenario one after the other"""
+        self.deploy = Deploy(tempfile.mkdtemp())
+        for node in NODES:
+            os.mkdir(join(self.deploy.root, node))
+        patches = {'DEPLOY': self.deploy,
+                   'save_spans': self.save_spans,
+                   'handle_event': self.handle_event,
+                   'event_context': self.event_context,
+                   'adopt': self.adopt}
+        self.original = {k: getattr(handler, k) for k in patches}
+        for name, value in patches.items():
+            setattr(handler, name, value)
+        session = handler.CONSUL.session
+        docker = handler.DOCKER.session
+        runners = [b.runner for b in handler.BACKENDS]
+        handler.CONSUL.session = SlowSession(self)
+        handler.DOCKER.session = DockerSession(self)
+        for backend in handler.BACKENDS:
+            backend.runner = self.run
+        try:
+            for name, payload in scenario:
+                yield self.step(name, payload)
+        finally:
+            rmtree(self.deploy.root)
+            for name, value in self.original.items():
+                setattr(handler, name, value)
+            handler.CONSUL.session = session
+            handler.DOCKER.session = docker
+            for backend, runner in zip(handler.BACKENDS, runners):
+                backend.runner = runner
+
+
+class SlowSession(TestSession):
+    """in-memory consul answering with a latency"""
+    def __init__(self, simulator):
+        super().__init__()
+        self.simulator = simulator
+
+    def request(self, *args, **kwargs):
+        self.simulator.sleep('consul')
+        return super().request(*args, **kwargs)
+
+
+class DockerSession(object):
+    """docker socket of the nodes, with the volumes of the cluster"""
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def request(self, method, path):
+        self.simulator.sleep('docker')
+        if path == '/volumes':
+            with self.simulator.lock:
+                return 200, {'Volumes': [
+                    {'Name': v, 'Driver': handler.BTRFSDRIVER}
+                    for v in sorted(self.simulator.volumes)]}
+        return 200, []
+
+
+def report(step):
+    """print the timeline of an event"""
+    payload = step['payload']
+    print('\n{}: {}s, downtime {}'.format(
+        ' '.join([step['event']] + (
+            [payload['repo'] + '@' + payload['branch']]
+            if 'repo' in payload else [])
+            + ['{}={}'.format(k, payload[k]) for k in
+               ('master', 'slave', 'bluegreen', 'target', 'node')
+               if k in payload]),
+        step['duration'], ', '.join(
+            '{}s'.format(d) if len(step['downtime']) == 1
+            else '{} {}s'.format(app, d)
+            for app, d in step['downtime'].items()) or 'none'))
+    for node, timeline in step['nodes'].items():
+        print('  {} {}{}'.format(
+            node, timeline['transition'],
+            ' FAILED: ' + timeline['error'] if timeline['error'] else ''))
+        for phase in sorted(timeline['phases'], key=lambda p: p['start']):
+            print('    {:>7.1f} {:>7.1f}  {}{}'.format(
+                phase['start'], phase['start'] + phase['duration'],
+                phase['phase'],
+                '' if phase['outcome'] == 'ok' else ' (failed)'))
+
+
+def latency(value):
+    name, seconds = value.rsplit('=', 1)
+    return name.strip(), float(seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', type=float, default=0.01,
+                        help='real seconds per simulated second')
+    parser.add_argument('--latency', type=latency, action='append',
+                        default=[], metavar='COMMAND=SECONDS',
+                        help='latency of a command, ex: "docker-compose '
+                             'build=120". Known commands: '
+                             + ', '.join(LATENCIES))
+    parser.add_argument('--json', action='store_true',
+                        help='print the timelines as json lines')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+    latencies = OrderedDict(LATENCIES, **dict(args.latency))
+    for step in Simulator(latencies, args.scale).simulate():
+        if args.json:
+            print(json.dumps(step), flush=True)
+        else:
+            report(step)